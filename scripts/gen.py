@@ -1,7 +1,9 @@
 from __future__ import print_function
 
 import argparse
-import collections.abc
+import concurrent.futures
+import functools
+import itertools
 import lark
 import json
 import os
@@ -10,33 +12,88 @@ import string
 import sys
 
 
-def namedtuple_with_defaults(typename, field_names, default_values=()):
-  ntuple = collections.namedtuple(typename, field_names)
-  ntuple.__new__.__defaults__ = (None,) * len(ntuple._fields)
-  if isinstance(default_values, collections.abc.Mapping):
-    prototype = ntuple(**default_values)
-  else:
-    prototype = ntuple(*default_values)
-  ntuple.__new__.__defaults__ = tuple(prototype)
-  return ntuple
-
+# Matches the $N / ${N} placeholders accepted in outfn_template strings.
+# A precompiled pattern with a direct dict lookup is faster than going
+# through string.Template.substitute for every expanded call.
+_TMPL_RE = re.compile(r'\$(?:\{([a-z0-9_]+)\}|([a-z0-9_]+))')
 
-class ArgTemplate(string.Template):
-  idpattern = r'[a-z0-9_]+'
 
+class FuncDef(object):
+  __slots__ = ('cpp_sig', 'aten_sig', 'dispatch', 'math')
 
-FuncDef = namedtuple_with_defaults('FuncDef',
-                                   'cpp_sig, aten_sig, dispatch, math')
+  def __init__(self, cpp_sig=None, aten_sig=None, dispatch=None, math=None):
+    self.cpp_sig = cpp_sig
+    self.aten_sig = aten_sig
+    self.dispatch = dispatch
+    self.math = math
 
-FuncGen = namedtuple_with_defaults(
-    'FuncGen',
-    'tree, xtree, rwxtree, func, xfunc, code, sig, rwsig, cppsig, funsig, mapsig, aten_sig, dispatch, math'
-)
-
-FuncOpts = namedtuple_with_defaults(
-    'FuncOpts',
-    'ref_param, device_param, wparams, outfn_template, outfn_name, shape_check_indices'
-)
+  def __repr__(self):
+    return 'FuncDef(cpp_sig={!r}, aten_sig={!r}, dispatch={!r}, math={!r})'.format(
+        self.cpp_sig, self.aten_sig, self.dispatch, self.math)
+
+
+class FuncGen(object):
+  __slots__ = ('tree', 'rwxtree', 'func', 'xfunc', 'xla_qname', 'code', 'sig',
+               'rwsig', 'cppsig', 'funsig', 'overload', 'mapsig', 'mapsig_key',
+               'autograd', 'aten_sig', 'dispatch', 'math')
+
+  def __init__(self,
+               tree=None,
+               rwxtree=None,
+               func=None,
+               xfunc=None,
+               xla_qname=None,
+               code=None,
+               sig=None,
+               rwsig=None,
+               cppsig=None,
+               funsig=None,
+               overload=None,
+               mapsig=None,
+               mapsig_key=None,
+               autograd=None,
+               aten_sig=None,
+               dispatch=None,
+               math=None):
+    self.tree = tree
+    self.rwxtree = rwxtree
+    self.func = func
+    self.xfunc = xfunc
+    self.xla_qname = xla_qname
+    self.code = code
+    self.sig = sig
+    self.rwsig = rwsig
+    self.cppsig = cppsig
+    self.funsig = funsig
+    self.overload = overload
+    self.mapsig = mapsig
+    self.mapsig_key = mapsig_key
+    self.autograd = autograd
+    self.aten_sig = aten_sig
+    self.dispatch = dispatch
+    self.math = math
+
+
+class FuncOpts(object):
+  __slots__ = ('ref_param', 'device_param', 'wparams', 'outfn_template',
+               'outfn_name', 'shape_check_indices')
+
+  def __init__(self,
+               ref_param=None,
+               device_param=None,
+               wparams=None,
+               outfn_template=None,
+               outfn_name=None,
+               shape_check_indices=None):
+    self.ref_param = ref_param
+    self.device_param = device_param
+    # Normalize the collection fields once at construction; wparams is only
+    # ever membership-tested and shape_check_indices only iterated.
+    self.wparams = frozenset(wparams) if wparams else None
+    self.outfn_template = outfn_template
+    self.outfn_name = outfn_name
+    self.shape_check_indices = tuple(
+        shape_check_indices) if shape_check_indices is not None else None
 
 _GRAMMAR = r"""
     start: type fnname "(" params ")"
@@ -76,19 +133,54 @@ _GRAMMAR = r"""
     %ignore WS
     """
 
-_PARSER = lark.Lark(_GRAMMAR, parser='lalr', propagate_positions=True)
+# Position propagation is only needed by StringEmit, which operates on the
+# keep_all_tokens trees produced by _XPARSER. The _PARSER trees are only ever
+# walked structurally, so skip the position bookkeeping there.
+# The cache option serializes the compiled LALR tables to a temporary file,
+# so reruns of the generator skip the grammar analysis entirely.
+_PARSER = lark.Lark(
+    _GRAMMAR,
+    parser='lalr',
+    lexer='contextual',
+    propagate_positions=False,
+    cache=True)
 
 _XPARSER = lark.Lark(
-    _GRAMMAR, parser='lalr', propagate_positions=True, keep_all_tokens=True)
+    _GRAMMAR,
+    parser='lalr',
+    lexer='contextual',
+    propagate_positions=True,
+    keep_all_tokens=True,
+    cache=True)
+
+
+# Parsing is the dominant cost of the generator, and the same signature gets
+# parsed multiple times on its way through the pipeline. Cache the parse trees
+# keyed on the raw signature string so each unique signature is parsed at most
+# once per parser.
+@functools.lru_cache(maxsize=None)
+def _parse(sig):
+  return _PARSER.parse(sig)
+
+
+@functools.lru_cache(maxsize=None)
+def _xparse(sig):
+  return _XPARSER.parse(sig)
 
 # _FN_AUTOGRAD_XLA/_FN_BLACKLIST takes either name or mapsig.
 _FN_BLACKLIST = set([])
 
 # List of non-leaf ops we want to override both forward + backward.
 # TODO(https://github.com/pytorch/pytorch/issues/39959)
-_FN_AUTOGRAD_XLA = set([
-    'max_pool2d(Tensor, IntArrayRef, IntArrayRef, IntArrayRef, IntArrayRef, bool) -> Tensor',
-    'max_pool3d(Tensor, IntArrayRef, IntArrayRef, IntArrayRef, IntArrayRef, bool) -> Tensor',
+# The members are interned so membership tests against interned mapsigs can
+# take the pointer-equality fast path.
+_FN_AUTOGRAD_XLA = frozenset([
+    sys.intern(
+        'max_pool2d(Tensor, IntArrayRef, IntArrayRef, IntArrayRef, IntArrayRef, bool) -> Tensor'
+    ),
+    sys.intern(
+        'max_pool3d(Tensor, IntArrayRef, IntArrayRef, IntArrayRef, IntArrayRef, bool) -> Tensor'
+    ),
 ])
 
 _FN_BLACKLIST_REGEX = [
@@ -97,6 +189,14 @@ _FN_BLACKLIST_REGEX = [
     # XLA/TPU functions
 ]
 
+# Single alternation over _FN_BLACKLIST_REGEX, so each blacklist lookup is one
+# match call instead of a Python loop over the patterns.
+_FN_BLACKLIST_RE = re.compile('|'.join(
+    '(?:{})'.format(p)
+    for p in _FN_BLACKLIST_REGEX)) if _FN_BLACKLIST_REGEX else None
+
+_HAS_BLACKLIST = bool(_FN_BLACKLIST) or _FN_BLACKLIST_RE is not None
+
 _FN_OUT = {
     'abs_out': FuncOpts(),
     'add_out': FuncOpts(),
@@ -138,6 +238,14 @@ _FN_OUT = {
 # second.
 _FN_OUT_REGEX = []
 
+# Single alternation over _FN_OUT_REGEX using named groups, with a parallel
+# list mapping the matched group back to its FuncOpts.
+_FN_OUT_RE = re.compile('|'.join(
+    '(?P<g{}>{})'.format(i, p)
+    for i, (p, _) in enumerate(_FN_OUT_REGEX))) if _FN_OUT_REGEX else None
+
+_FN_OUT_RE_OPTS = [fnopts for _, fnopts in _FN_OUT_REGEX]
+
 _FN_REMAP = {
     '_th_eq(Tensor, Scalar) -> Tensor':
         FuncOpts(outfn_name='AtenXlaType::eq'),
@@ -195,23 +303,32 @@ _TYPE_NSMAP = {
     'DimnameList': 'at::DimnameList',  # namedtensor-only
 }
 
-_H_HEADER = """// Autogenerated file by {gen}. Do not edit directly!
+# The headers are split around the generated sections, so the output can be
+# streamed to the files piecewise instead of being assembled into one giant
+# string first. Only the leading segments take the $gen substitution; they
+# are precompiled string.Template objects so the template text is parsed
+# once, and the tail segments are written verbatim.
+_H_HEADER_PRE = string.Template(
+    """// Autogenerated file by $gen. Do not edit directly!
 
 #include <ATen/Tensor.h>
 
-namespace torch_xla {{
+namespace torch_xla {
 
-class AtenXlaTypeDefault {{
+class AtenXlaTypeDefault {
  public:
-{hfuncs}
-}};
+""")
+
+_H_HEADER_POST = """
+};
 
 void RegisterAtenTypeFunctions();
 
-}}  // namespace torch_xla
+}  // namespace torch_xla
 """
 
-_CPP_HEADER = """// Autogenerated file by {gen}. Do not edit directly!
+_CPP_HEADER_PRE = string.Template(
+    """// Autogenerated file by $gen. Do not edit directly!
 #include "torch_xla/csrc/aten_xla_type_default.h"
 
 #include <ATen/Context.h>
@@ -225,12 +342,14 @@ _CPP_HEADER = """// Autogenerated file by {gen}. Do not edit directly!
 #include "torch_xla/csrc/aten_xla_type.h"
 #include "torch_xla/csrc/function_call_tracker.h"
 
-namespace torch_xla {{
+namespace torch_xla {
+
+""")
 
-{funcs}
+_CPP_FUNCS_REGS_SEP = '\n\n'
 
-{regs}
-}}  // namespace torch_xla
+_CPP_HEADER_POST = """
+}  // namespace torch_xla
 """
 
 _XLA_FUNCTIONS = {}
@@ -256,52 +375,63 @@ _FUNCTION_OPTIONS = {
 
 _RESULT_NAME = 'x_result'
 
+_OUT_FN_RE = re.compile(r'(.*)_out$')
+
+_TENSOR_TYPE_RE = re.compile(r'\bTensor\b')
+
 
 class Context(object):
 
   def __init__(self, functions):
     with open(functions, 'r') as ff:
-      self.functions_data = ff.read()
+      functions_data = ff.read()
+    # Index the declared function names by their qualified form once, instead
+    # of scanning the whole file for ' <name>(' on every lookup.
+    self.functions = {
+        name: 'at::' + name
+        for name in re.findall(r' ([a-zA-Z0-9_]+)\(', functions_data)
+    }
 
   def get_function(self, name):
-    if self.functions_data.find(' {}('.format(name)) >= 0:
-      return 'at::{}'.format(name)
+    return self.functions.get(name, None)
 
 
 class StringEmit(object):
 
   def __init__(self, sref):
     self.sref = sref
-    self.sval = ''
+    self.sparts = []
     self.pos = -1
 
   def __repr__(self):
-    return self.sval
+    return ''.join(self.sparts)
 
   def advance(self, t):
     start = t.column - 1
     end = t.end_column - 1
     pos = self.pos if self.pos >= 0 else start
     if start > pos:
-      self.sval += self.sref[pos:start]
-    self.sval += t.value
+      self.sparts.append(self.sref[pos:start])
+    self.sparts.append(t.value)
     self.pos = end
 
   def skip(self, t):
     self.pos = last_match(t) if self.pos >= 0 else -1
 
   def append(self, s):
-    self.sval += s
+    self.sparts.append(s)
     self.pos = -1
 
 
 class TensorFetcher(object):
+  __slots__ = ('var_name', 'tvar_name', 'optvar_name', 'toptvar_name',
+               'tensors', 'opt_tensors', 'writeable')
 
   def __init__(self, var_name):
     self.var_name = var_name
-    self.tvar_name = '{}_tensors'.format(self.var_name)
-    self.optvar_name = '{}_opt'.format(var_name)
-    self.toptvar_name = '{}_tensors'.format(self.optvar_name)
+    self.tvar_name = f'{var_name}_tensors'
+    self.optvar_name = f'{var_name}_opt'
+    self.toptvar_name = f'{var_name}_opt_tensors'
     self.tensors = []
     self.opt_tensors = []
     self.writeable = []
@@ -310,35 +440,35 @@ class TensorFetcher(object):
     if writeable:
       self.writeable.append(len(self.tensors))
     self.tensors.append(name)
-    return '{}[{}]'.format(self.var_name, len(self.tensors) - 1)
+    return f'{self.var_name}[{len(self.tensors) - 1}]'
 
   def add_opt(self, name):
     self.opt_tensors.append(name)
-    return '{}[{}]'.format(self.optvar_name, len(self.opt_tensors) - 1)
+    return f'{self.optvar_name}[{len(self.opt_tensors) - 1}]'
 
   def generate_fetches(self):
-    code = ''
-    code += '  std::vector<at::Tensor> {} = {{{}}};\n'.format(
-        self.tvar_name, ', '.join(self.tensors))
-    code += ('  auto {} = bridge::XlaCreateTensorList({});\n').format(
-        self.var_name, self.tvar_name)
+    parts = [
+        f'  std::vector<at::Tensor> {self.tvar_name} = '
+        f'{{{", ".join(self.tensors)}}};\n',
+        f'  auto {self.var_name} = '
+        f'bridge::XlaCreateTensorList({self.tvar_name});\n',
+    ]
     # Handles conversion of c10::optional<at::Tensor> if exists
     if self.opt_tensors:
-      code += '  std::vector<c10::optional<at::Tensor>> {} = {{{}}};\n'.format(
-          self.toptvar_name, ', '.join(self.opt_tensors))
-      code += ('  auto {} = bridge::XlaCreateOptTensorList({});\n').format(
-          self.optvar_name, self.toptvar_name)
-    return code
+      parts.append(f'  std::vector<c10::optional<at::Tensor>> '
+                   f'{self.toptvar_name} = {{{", ".join(self.opt_tensors)}}};\n')
+      parts.append(f'  auto {self.optvar_name} = '
+                   f'bridge::XlaCreateOptTensorList({self.toptvar_name});\n')
+    return ''.join(parts)
 
   def generate_updates(self):
-    code = ''
-    if self.writeable:
-      ivar_name = '{}_update_indices'.format(self.var_name)
-      code += '  std::vector<size_t> {} = {{{}}};\n'.format(
-          ivar_name, ', '.join(str(x) for x in self.writeable))
-      code += '  bridge::XlaUpdateTensors({}, {}, {});\n'.format(
-          self.tvar_name, self.var_name, ivar_name)
-    return code
+    if not self.writeable:
+      return ''
+    ivar_name = f'{self.var_name}_update_indices'
+    return (f'  std::vector<size_t> {ivar_name} = '
+            f'{{{", ".join(map(str, self.writeable))}}};\n'
+            f'  bridge::XlaUpdateTensors({self.tvar_name}, {self.var_name}, '
+            f'{ivar_name});\n')
 
 
 def list_get(l, n):
@@ -346,12 +476,12 @@ def list_get(l, n):
 
 
 def is_blacklisted_fn(fname, mapsig):
+  if not _HAS_BLACKLIST:
+    return False
   if fname in _FN_BLACKLIST or mapsig in _FN_BLACKLIST:
     return True
-  for frx in _FN_BLACKLIST_REGEX:
-    if re.match(frx, fname) or re.match(frx, mapsig):
-      return True
-  return False
+  return bool(_FN_BLACKLIST_RE is not None and
+              (_FN_BLACKLIST_RE.match(fname) or _FN_BLACKLIST_RE.match(mapsig)))
 
 
 def get_outfn_options(fname, mapsig):
@@ -359,9 +489,12 @@ def get_outfn_options(fname, mapsig):
     fnopts = _FN_OUT.get(name, None)
     if fnopts is not None:
       return fnopts
-  for frx, fnopts in _FN_OUT_REGEX:
-    if re.match(frx, fname) or re.match(frx, mapsig):
-      return fnopts
+  if _FN_OUT_RE is not None:
+    m = _FN_OUT_RE.match(fname) or _FN_OUT_RE.match(mapsig)
+    if m:
+      for i, fnopts in enumerate(_FN_OUT_RE_OPTS):
+        if m.group('g{}'.format(i)) is not None:
+          return fnopts
 
 
 def get_remapfn_options(fname, mapsig):
@@ -372,52 +505,51 @@ def get_remapfn_options(fname, mapsig):
 
 
 def is_write_param(fnopts, pname, defval):
-  if fnopts and fnopts.wparams:
-    if pname in fnopts.wparams:
-      return True
+  if fnopts is not None and fnopts.wparams and pname in fnopts.wparams:
+    return True
   return defval
 
 
 def first_match(t):
-  if isinstance(t, lark.lexer.Token):
-    return t.column - 1
-  assert isinstance(t, lark.tree.Tree)
-  return first_match(t.children[0])
+  while isinstance(t, lark.tree.Tree):
+    t = t.children[0]
+  assert isinstance(t, lark.lexer.Token)
+  return t.column - 1
 
 
 def last_match(t):
-  if isinstance(t, lark.lexer.Token):
-    return t.end_column - 1
-  assert isinstance(t, lark.tree.Tree)
-  return last_match(t.children[-1])
+  while isinstance(t, lark.tree.Tree):
+    t = t.children[-1]
+  assert isinstance(t, lark.lexer.Token)
+  return t.end_column - 1
 
 
 def for_every_token(t, fn):
-  if isinstance(t, lark.lexer.Token):
-    fn(t)
-  else:
-    assert isinstance(t, lark.tree.Tree)
-    for c in t.children:
-      for_every_token(c, fn)
+  stack = [t]
+  while stack:
+    t = stack.pop()
+    if isinstance(t, lark.lexer.Token):
+      fn(t)
+    else:
+      assert isinstance(t, lark.tree.Tree)
+      stack.extend(reversed(t.children))
 
 
 def emit_string(t, emit, emit_fn):
-  status = emit_fn(t)
-  if status > 0:
-
-    def do_emit(tok):
-      emit.advance(tok)
-
-    for_every_token(t, do_emit)
-  elif status == 0:
-    if isinstance(t, lark.lexer.Token):
-      emit.advance(t)
+  stack = [t]
+  while stack:
+    t = stack.pop()
+    status = emit_fn(t)
+    if status > 0:
+      for_every_token(t, emit.advance)
+    elif status == 0:
+      if isinstance(t, lark.lexer.Token):
+        emit.advance(t)
+      else:
+        assert isinstance(t, lark.tree.Tree)
+        stack.extend(reversed(t.children))
     else:
-      assert isinstance(t, lark.tree.Tree)
-      for c in t.children:
-        emit_string(c, emit, emit_fn)
-  else:
-    emit.skip(t)
+      emit.skip(t)
 
 
 def typed_child(t, n, ttype):
@@ -436,11 +568,13 @@ def rewrite_sig(tree, orig_sig, emit_fn=lambda x: 0):
 
 
 def rewrite_signature(sig, tmap):
+  rewritten = []
 
   def rewrite(t):
     if t.type == 'TNAME':
       new_type = tmap.get(t.value, None)
       if new_type is not None:
+        rewritten.append((t, t.value))
         t.value = new_type
 
   def emit_fn(t):
@@ -448,12 +582,36 @@ def rewrite_signature(sig, tmap):
       return 0
     return -1 if t.data == 'param_defval' else 0
 
-  xtree = _XPARSER.parse(sig)
+  xtree = _xparse(sig)
   for_every_token(xtree, rewrite)
-  return rewrite_sig(xtree, sig, emit_fn=emit_fn)
+  try:
+    return rewrite_sig(xtree, sig, emit_fn=emit_fn)
+  finally:
+    # The tree is shared through the parse cache, so undo the token rewrites
+    # once the new signature has been emitted.
+    for token, value in rewritten:
+      token.value = value
+
+
+@functools.lru_cache(maxsize=None)
+def rewrite_aten_signature(sig):
+  return rewrite_signature(sig, _TYPE_NSMAP)
+
+
+# The signature emitters below are deterministic functions of the original
+# signature string (the tree is always its parse), so their outputs can be
+# memoized on the string alone.
+_STDFUNC_SIG_CACHE = {}
+
+_MAP_SIG_CACHE = {}
 
 
 def create_stdfunc_sig(tree, orig_sig):
+  # Returns the signature and the index of its opening paren, which is known
+  # at emission time, so no caller needs to scan for it afterwards.
+  cached = _STDFUNC_SIG_CACHE.get(orig_sig, None)
+  if cached is not None:
+    return cached
 
   def emit_fn(t):
     if isinstance(t, lark.lexer.Token):
@@ -463,14 +621,20 @@ def create_stdfunc_sig(tree, orig_sig):
   emit = StringEmit(orig_sig)
   # Emit full function return type.
   emit_string(typed_child(tree, 0, 'type'), emit, emit_fn)
+  pos = sum(len(part) for part in emit.sparts)
   emit.append('(')
   # Emit parameter list w/out parameter names.
   emit_string(typed_child(tree, 3, 'params'), emit, emit_fn)
   emit.append(')')
-  return str(emit)
+  cached = (str(emit), pos)
+  _STDFUNC_SIG_CACHE[orig_sig] = cached
+  return cached
 
 
 def create_map_sig(tree, orig_sig):
+  mapsig = _MAP_SIG_CACHE.get(orig_sig, None)
+  if mapsig is not None:
+    return mapsig
 
   def emit_fn(t):
     if isinstance(t, lark.lexer.Token):
@@ -485,7 +649,18 @@ def create_map_sig(tree, orig_sig):
   emit_string(typed_child(tree, 3, 'params'), emit, emit_fn)
   emit.append(') -> ')
   emit_string(typed_child(tree, 0, 'type'), emit, emit_fn)
-  return str(emit)
+  mapsig = str(emit)
+  _MAP_SIG_CACHE[orig_sig] = mapsig
+  return mapsig
+
+
+def get_map_sig(sig):
+  # Parse lazily, so a cache hit avoids building the keep_all_tokens tree
+  # altogether.
+  mapsig = _MAP_SIG_CACHE.get(sig, None)
+  if mapsig is None:
+    mapsig = create_map_sig(_xparse(sig), sig)
+  return mapsig
 
 
 def type_core(t):
@@ -516,12 +691,15 @@ def type_is_refptr(t, kind):
 
 
 def extract_list(t, l):
-  assert isinstance(t, lark.tree.Tree)
-  l.append(t.children[0])
-  if len(t.children) == 2:
+  while True:
+    assert isinstance(t, lark.tree.Tree)
+    l.append(t.children[0])
+    if len(t.children) != 2:
+      break
     c = t.children[1]
-    if isinstance(c, lark.tree.Tree) and c.data == t.data:
-      extract_list(c, l)
+    if not isinstance(c, lark.tree.Tree) or c.data != t.data:
+      break
+    t = c
   return l
 
 
@@ -586,10 +764,37 @@ def param_type(t):
   return c
 
 
+class ParamInfo(object):
+  """Metadata for one signature parameter, extracted in a single pass.
+
+  The code generators repeatedly need the name, core type and qualifiers of
+  each parameter; poking at the Lark tree for each query walks the same nodes
+  over and over, so extract everything once up front.
+  """
+
+  __slots__ = ('tree', 'name', 'core_type', 'is_const', 'opt_inner')
+
+  def __init__(self, tree):
+    ptype = param_type(tree)
+    self.tree = tree
+    self.name = param_name(tree)
+    self.core_type = type_core(ptype)
+    self.is_const = type_is_const(ptype)
+    # The core type wrapped by c10::optional<>, if any.
+    self.opt_inner = type_core(get_template_type_list(ptype)[
+        0]) if self.core_type == 'c10::optional' else None
+
+
+def analyze_params(params):
+  return [ParamInfo(p) for p in params]
+
+
 def get_optional(fnopts, name, defval=None):
-  if fnopts is None or not hasattr(fnopts, name):
+  # FuncOpts declares all its fields via __slots__, so the attribute is always
+  # present and can be read directly.
+  if fnopts is None:
     return defval
-  return getattr(fnopts, name, defval) or defval
+  return getattr(fnopts, name) or defval
 
 
 def get_return_value(rtype, rname, param, var, ref_param, fnopts):
@@ -599,7 +804,7 @@ def get_return_value(rtype, rname, param, var, ref_param, fnopts):
     # parameter. In these cases we operated on XLA tensors data (the ATEN one),
     # but the returned references are the input parameters.
     assert param
-    return param_name(param)
+    return param.name
   elif crtype != 'Tensor':
     return rname
   else:
@@ -607,7 +812,7 @@ def get_return_value(rtype, rname, param, var, ref_param, fnopts):
     # wrapping the proper local variable which has been created by calling
     # into the CPU tensor implementation.
     return 'bridge::CreateXlaTensor({}, bridge::GetXlaDevice({}))'.format(
-        rname, get_optional(fnopts, 'device_param', param_name(ref_param)))
+        rname, get_optional(fnopts, 'device_param', ref_param.name))
 
 
 def get_reference_param(params, fnopts=None):
@@ -616,20 +821,18 @@ def get_reference_param(params, fnopts=None):
   ref_param = None
   other = None
   for p in params:
-    ptype = param_type(p)
-    cptype = type_core(ptype)
+    cptype = p.core_type
     # Unwrap core type within c10::optional<>
     if cptype == 'c10::optional':
-      cptype = type_core(get_template_type_list(ptype)[0])
-    pname = param_name(p)
-    if get_optional(fnopts, 'ref_param') == pname:
+      cptype = p.opt_inner
+    if get_optional(fnopts, 'ref_param') == p.name:
       return p
     if not other and (cptype == 'TensorOptions' or cptype == 'TensorList' or
                       cptype == 'Device'):
       other = p
     if cptype != 'Tensor':
       continue
-    if not ref_param and (pname == 'self' or type_is_const(ptype)):
+    if not ref_param and (p.name == 'self' or p.is_const):
       ref_param = p
     other = p
   return ref_param or other
@@ -661,20 +864,17 @@ def get_return_type_str(t, orig_sig):
 def generate_entry_debug_code(t, fname, params, fname_ns=None):
   # Emits debug code for a given intercepted ATEN type function. For now we use
   # a counter which will show up in the metrics reports.
-  code = '  XLA_FN_TRACK(3);\n'
+  parts = ['  XLA_FN_TRACK(3);\n']
   if fname_ns is not None:
-    code += '  XLA_COUNTER("{}::{}", 1);\n'.format(fname_ns, fname)
+    parts.append(f'  XLA_COUNTER("{fname_ns}::{fname}", 1);\n')
   # VLOG info. Use the following to see debug output:
   #  export TF_CPP_VMODULE=aten_xla_type_default=3
-  code += '  TF_VLOG(3) << "XLA {} :"'.format(fname)
+  parts.append(f'  TF_VLOG(3) << "XLA {fname} :"')
   for p in params:
-    ptype = param_type(p)
-    cptype = type_core(ptype)
-    pname = param_name(p)
-    if cptype == 'Tensor':
-      code += ' << " {}=" << {}.toString()'.format(pname, pname)
-  code += ';\n'
-  return code
+    if p.core_type == 'Tensor':
+      parts.append(f' << " {p.name}=" << {p.name}.toString()')
+  parts.append(';\n')
+  return ''.join(parts)
 
 
 def generate_exit_debug_code(t, fname, rname, params, param_vars):
@@ -692,7 +892,7 @@ def generate_return_stmt(t, rtype_str, fname, rname, params, param_vars,
                               ref_param, fnopts)
   elif ctype == 'std::vector':
     retstr = 'bridge::CreateXlaTensors({}, bridge::GetXlaDevice({}))'.format(
-        rname, get_optional(fnopts, 'device_param', param_name(ref_param)))
+        rname, get_optional(fnopts, 'device_param', ref_param.name))
   elif ctype == 'Tensor':
     retstr = get_return_value(rtype, rname, params[0], param_vars[0], ref_param,
                               fnopts)
@@ -733,18 +933,14 @@ def rewrite_tensor_options(fname, pname):
 
 
 def get_param_names(params):
-  param_vars = []
-  for p in params:
-    pname = param_name(p)
-    param_vars.append(pname)
-  return param_vars
+  return [p.name for p in params]
 
 
 def expand_fn_template(tmpl, param_vars):
   mdict = {}
   for i, pname in enumerate(param_vars):
     mdict[str(i)] = pname
-  return tmpl.substitute(mdict)
+  return _TMPL_RE.sub(lambda m: mdict[m.group(1) or m.group(2)], tmpl)
 
 
 def create_call(fname, param_vars):
@@ -752,16 +948,17 @@ def create_call(fname, param_vars):
 
 
 def generate_shape_checks(param_vars, shape_check_indices, fname):
-  code = ''
+  parts = []
   for i, j in shape_check_indices:
-    code += ('  XLA_CHECK({}.sizes() == {}.sizes()) << "Operand shapes must be '
-             'identical for {}, mismatch for arguments {} and {}";\n').format(
-                 param_vars[i], param_vars[j], fname, i + 1, j + 1)
-  return code
+    parts.append(
+        f'  XLA_CHECK({param_vars[i]}.sizes() == {param_vars[j]}.sizes()) << '
+        f'"Operand shapes must be identical for {fname}, mismatch for '
+        f'arguments {i + 1} and {j + 1}";\n')
+  return ''.join(parts)
 
 
 def generate_aten_remap(ctx, fname, sig, params, fnopts):
-  code = '{} {{\n'.format(sig)
+  parts = [f'{sig} {{\n']
 
   param_vars = get_param_names(params)
   if fnopts.outfn_template is not None:
@@ -771,10 +968,11 @@ def generate_aten_remap(ctx, fname, sig, params, fnopts):
     fcall = create_call(fnopts.outfn_name, param_vars)
 
   if fnopts.shape_check_indices is not None:
-    code += generate_shape_checks(param_vars, fnopts.shape_check_indices, fname)
-  code += '  return {};\n'.format(fcall)
-  code += '}'
-  return code
+    parts.append(
+        generate_shape_checks(param_vars, fnopts.shape_check_indices, fname))
+  parts.append(f'  return {fcall};\n')
+  parts.append('}')
+  return ''.join(parts)
 
 
 def generate_outfn_result_copy(dest, src):
@@ -788,122 +986,122 @@ def generate_aten_out(ctx, tree, rwxtree, fname, sig, rwsig, params, fnopts):
   if type_core(rtype) == 'std::tuple':
     num_outputs = len(get_template_type_list(rtype))
 
-  code = '{} {{\n'.format(sig)
-  code += generate_entry_debug_code(tree, fname, params)
+  parts = [f'{sig} {{\n', generate_entry_debug_code(tree, fname, params)]
 
   param_vars = get_param_names(params)
   if fnopts.outfn_template is not None:
     fcall = expand_fn_template(fnopts.outfn_template, param_vars)
   else:
-    m = re.match(r'(.*)_out$', fname)
+    m = _OUT_FN_RE.match(fname)
     assert m is not None, fname
     out_count = num_outputs if num_outputs is not None else 1
-    fcall = create_call('AtenXlaType::{}'.format(m.group(1)),
-                        param_vars[out_count:])
+    fcall = create_call(f'AtenXlaType::{m.group(1)}', param_vars[out_count:])
 
-  tmp_result = '{}_tmp'.format(fname)
-  code += '  auto {} = {};\n'.format(tmp_result, fcall)
+  tmp_result = f'{fname}_tmp'
+  parts.append(f'  auto {tmp_result} = {fcall};\n')
   if num_outputs is None:
-    code += generate_outfn_result_copy(param_vars[0], tmp_result)
-    code += generate_exit_debug_code(tree, fname, param_vars[0], params,
-                                     param_vars)
-    code += '  return {};\n'.format(param_vars[0])
+    parts.append(generate_outfn_result_copy(param_vars[0], tmp_result))
+    parts.append(
+        generate_exit_debug_code(tree, fname, param_vars[0], params,
+                                 param_vars))
+    parts.append(f'  return {param_vars[0]};\n')
   else:
     for i in range(0, num_outputs):
-      code += generate_outfn_result_copy(
-          param_vars[i], 'std::get<{}>({})'.format(i, tmp_result))
-    code += generate_exit_debug_code(tree, fname, param_vars[0:num_outputs],
-                                     params, param_vars)
-    code += '  return {}('.format(get_return_type_str(rwxtree, rwsig))
-    for i in range(0, num_outputs):
-      if i > 0:
-        code += ', '
-      code += param_vars[i]
-    code += ');\n'
-  code += '}'
-  return code
+      parts.append(
+          generate_outfn_result_copy(param_vars[i],
+                                     f'std::get<{i}>({tmp_result})'))
+    parts.append(
+        generate_exit_debug_code(tree, fname, param_vars[0:num_outputs],
+                                 params, param_vars))
+    parts.append(f'  return {get_return_type_str(rwxtree, rwsig)}(')
+    parts.append(', '.join(param_vars[0:num_outputs]))
+    parts.append(');\n')
+  parts.append('}')
+  return ''.join(parts)
 
 
 def generate_aten_to_xla(ctx, tree, rwxtree, fname, sig, rwsig, params, fnopts):
   ref_param = get_reference_param(params, fnopts=fnopts)
 
-  code = '{} {{\n'.format(sig)
-  code += generate_entry_debug_code(tree, fname, params, fname_ns='aten')
-  xla_ref_param = param_name(ref_param) if ref_param else None
+  parts = [
+      f'{sig} {{\n',
+      generate_entry_debug_code(tree, fname, params, fname_ns='aten')
+  ]
+  xla_ref_param = ref_param.name if ref_param else None
   tfetcher = TensorFetcher('xlatens')
   param_vars = []
   for p in params:
-    ptype = param_type(p)
-    cptype = type_core(ptype)
-    pname = param_name(p)
+    cptype = p.core_type
+    pname = p.name
     if cptype == 'TensorList':
-      xname = 'l_{}'.format(pname)
-      code += ('  auto {} = bridge::XlaCreateTensorList({});\n').format(
-          xname, pname)
+      xname = f'l_{pname}'
+      parts.append(f'  auto {xname} = bridge::XlaCreateTensorList({pname});\n')
       param_vars.append(xname)
     elif cptype == 'TensorOptions':
       gcode, xname = rewrite_tensor_options(fname, pname)
-      code += gcode
+      parts.append(gcode)
       param_vars.append(xname)
     elif cptype == 'c10::optional':
-      wrapped_type = type_core(get_template_type_list(ptype)[0])
-      if wrapped_type == 'Tensor':
+      if p.opt_inner == 'Tensor':
         xname = tfetcher.add_opt(pname)
         param_vars.append(xname)
       else:
         param_vars.append(pname)
     elif cptype != 'Tensor':
       param_vars.append(pname)
-    elif type_is_const(ptype):
+    elif p.is_const:
       xname = tfetcher.add(pname, is_write_param(fnopts, pname, False))
       param_vars.append(xname)
     else:
       xname = tfetcher.add(pname, is_write_param(fnopts, pname, True))
       param_vars.append(xname)
-    if p == ref_param and not get_optional(fnopts, 'ref_param'):
+    if p is ref_param and not get_optional(fnopts, 'ref_param'):
       xla_ref_param = param_vars[-1]
-  code += tfetcher.generate_fetches()
+  parts.append(tfetcher.generate_fetches())
   result_assign = generate_result_assignment(tree, _RESULT_NAME)
+  handling = get_handling_function(ctx, fname, xla_ref_param, param_vars)
   # TODO(https://github.com/pytorch/xla/issues/2240):
   # This hack should be removed soon once we update aten signatures.
   target_options = ['dtype', 'layout', 'device', 'pin_memory']
   if set(target_options).issubset(set(param_vars)):
-    code += '  at::TensorOptions options = at::TensorOptions().device(device).layout(layout).pinned_memory(pin_memory).dtype(dtype);\n'
-    code += '  {}{};\n'.format(
-        result_assign,
-        get_handling_function(ctx, fname, xla_ref_param, param_vars))
-    code = code.replace(', '.join(target_options), 'options')
+    parts.append(
+        '  at::TensorOptions options = at::TensorOptions().device(device).layout(layout).pinned_memory(pin_memory).dtype(dtype);\n'
+    )
+    parts.append(f'  {result_assign}{handling};\n')
+    parts = [''.join(parts).replace(', '.join(target_options), 'options')]
   else:
-    code += '  {}{};\n'.format(
-        result_assign,
-        get_handling_function(ctx, fname, xla_ref_param, param_vars))
-  code += tfetcher.generate_updates()
+    parts.append(f'  {result_assign}{handling};\n')
+  parts.append(tfetcher.generate_updates())
   if result_assign:
-    code += ('  static_cast<void>({}); // Avoid warnings in case not '
-             'used\n'.format(_RESULT_NAME))
-  code += generate_exit_debug_code(tree, fname,
-                                   _RESULT_NAME if result_assign else None,
-                                   params, param_vars)
-  code += generate_return_stmt(tree, get_return_type_str(rwxtree, rwsig), fname,
+    parts.append(f'  static_cast<void>({_RESULT_NAME}); // Avoid warnings in '
+                 'case not used\n')
+  parts.append(
+      generate_exit_debug_code(tree, fname,
                                _RESULT_NAME if result_assign else None, params,
-                               param_vars, ref_param, fnopts)
-  code += '}'
-  return code
+                               param_vars))
+  parts.append(
+      generate_return_stmt(tree, get_return_type_str(rwxtree, rwsig), fname,
+                           _RESULT_NAME if result_assign else None, params,
+                           param_vars, ref_param, fnopts))
+  parts.append('}')
+  return ''.join(parts)
 
 
 def get_xla_wrapper(fndef, ctx):
-  tree = _PARSER.parse(fndef.cpp_sig)
-  xtree = _XPARSER.parse(fndef.cpp_sig)
-  mapsig = create_map_sig(xtree, fndef.cpp_sig)
-  rwsig = rewrite_signature(fndef.cpp_sig, _TYPE_NSMAP)
-  rwxtree = _XPARSER.parse(rwsig)
-  params = get_parameters(tree)
+  tree = _parse(fndef.cpp_sig)
+  # Interned, so that the many set and dict lookups keyed on the mapsig can
+  # hit the pointer-equality fast path.
+  mapsig = sys.intern(get_map_sig(fndef.cpp_sig))
+  rwsig = rewrite_aten_signature(fndef.cpp_sig)
+  rwxtree = _xparse(rwsig)
+  params = analyze_params(get_parameters(tree))
   fnopts = _FUNCTION_OPTIONS.get(mapsig, None)
 
   def gen_fnname(x):
     return 'AtenXlaTypeDefault::{}'.format(x)
 
   sig, fname, xfname = get_function_signature(rwxtree, rwsig, gen_fnname)
+  fname = sys.intern(fname)
   if not is_blacklisted_fn(fname, mapsig):
     ofnopts = get_outfn_options(fname, mapsig)
     rfnopts = get_remapfn_options(fname, mapsig)
@@ -917,27 +1115,68 @@ def get_xla_wrapper(fndef, ctx):
                                   fnopts)
   else:
     code = None
+  funsig, pos = create_stdfunc_sig(rwxtree, rwsig)
   return FuncGen(
       tree=tree,
-      xtree=xtree,
       rwxtree=rwxtree,
       func=fname,
       xfunc=xfname,
+      xla_qname='AtenXlaType::' + fname,
       code=code,
       sig=fndef.cpp_sig,
       rwsig=rwsig,
       cppsig=sig,
       mapsig=mapsig,
-      funsig=create_stdfunc_sig(rwxtree, rwsig),
+      mapsig_key=get_mapsig_key(mapsig),
+      autograd=mapsig in _FN_AUTOGRAD_XLA or fname in _FN_AUTOGRAD_XLA,
+      funsig=funsig,
+      overload=funsig[:pos] + ' (*)' + funsig[pos:],
       aten_sig=fndef.aten_sig,
       dispatch=fndef.dispatch,
       math=fndef.math)
 
 
+def _xla_wrapper_worker(fndef, ctx):
+  try:
+    return get_xla_wrapper(fndef, ctx), None
+  except Exception as e:
+    return None, str(e)
+
+
+# With fewer definitions than this, the fork/pickle overhead of the process
+# pool outweighs the parallel parsing win; just run in-process.
+_PARALLEL_MIN_FNDEFS = 64
+
+
+def create_fgens(fndefs, ctx):
+  # Wrapper generation is a pure function of (fndef, ctx) and is dominated by
+  # CPU-bound parsing, so shard it across a process pool. Results and error
+  # reports keep the input order.
+  if len(fndefs) < _PARALLEL_MIN_FNDEFS:
+    results = [_xla_wrapper_worker(fndef, ctx) for fndef in fndefs]
+  else:
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+      results = list(
+          executor.map(
+              _xla_wrapper_worker, fndefs, itertools.repeat(ctx),
+              chunksize=64))
+  fgens = []
+  for fndef, (fgen, error) in zip(fndefs, results):
+    if error is not None:
+      print(
+          'Failed to generate wrapper for {}: {}'.format(fndef, error),
+          file=sys.stderr)
+    elif fgen:
+      fgens.append(fgen)
+  return fgens
+
+
 def is_tensor_api(fndef):
+  if 'Tensor' not in fndef:
+    return False, fndef
   fndef = fndef.replace('at::', '')
   fndef = fndef.replace('c10::Device', 'Device')
-  m = re.search(r'\bTensor\b', fndef)
+  m = _TENSOR_TYPE_RE.search(fndef)
   return m is not None, fndef
 
 
@@ -950,17 +1189,18 @@ def create_funcdef(fndef, jdata):
       math=fields.get('math', 'False') == 'True')
 
 
+_FNDEF_RE = re.compile(r'^\s*(\S.*); //[ \t]+(.*)$', re.MULTILINE)
+
+
 def extract_functions(path):
   functions = []
   errors = []
-
-  for line in open(path, 'r'):
-    m = re.match(r'\s*([^\s].*); //\s+(.*)', line)
-    if not m:
-      continue
+  with open(path, 'r') as ff:
+    data = ff.read()
+  for m in _FNDEF_RE.finditer(data):
     fndef = m.group(1)
     try:
-      _XPARSER.parse(fndef)
+      _xparse(fndef)
       functions.append(create_funcdef(fndef, m.group(2)))
     except Exception as e:
       if is_tensor_api(fndef)[0]:
@@ -976,65 +1216,145 @@ def get_mapsig_key(mapsig):
   return mapsig.replace(' ', '')
 
 
+def _split_toplevel(s):
+  # Splits on commas which are not nested inside brackets of any kind.
+  # Returns None if the brackets do not balance.
+  parts = []
+  depth = 0
+  start = 0
+  for i, c in enumerate(s):
+    if c in '(<[{':
+      depth += 1
+    elif c in ')>]}':
+      depth -= 1
+    elif c == ',' and depth == 0:
+      parts.append(s[start:i])
+      start = i + 1
+  if depth != 0:
+    return None
+  parts.append(s[start:])
+  return parts
+
+
+def _strip_type_tokens(s):
+  # Drops the const/ref/ptr decorations, like create_map_sig's emit_fn does.
+  return [
+      t for t in s.replace('&', ' ').replace('*', ' ').split() if t != 'const'
+  ]
+
+
+def fast_mapsig_key(fndef):
+  # Computes get_mapsig_key(get_map_sig(fndef)) with a single left-to-right
+  # scan instead of a full grammar parse. Only handles the plain signatures
+  # making up aten_xla_type.h; returns None whenever the input looks more
+  # structured than that, so the caller can fall back to the parser.
+  lpos = fndef.find('(')
+  rpos = fndef.rfind(')')
+  if lpos <= 0 or rpos < lpos:
+    return None
+  head = fndef[:lpos].rstrip()
+  spos = max(head.rfind(' '), head.rfind('&'), head.rfind('*'))
+  if spos < 0:
+    return None
+  fnname = head[spos + 1:]
+  rtype = ''.join(_strip_type_tokens(head[:spos + 1]))
+  params = _split_toplevel(fndef[lpos + 1:rpos])
+  if params is None:
+    return None
+  ptypes = []
+  for param in params:
+    pos = param.find('=')
+    if pos >= 0:
+      param = param[:pos]
+    tokens = _strip_type_tokens(param)
+    if not tokens:
+      if param.strip():
+        return None
+      continue
+    if len(tokens) > 2:
+      return None
+    ptypes.append(tokens[0])
+  return '{}({})->{}'.format(fnname, ','.join(ptypes), rtype)
+
+
+# Matches a whole static declaration in one go, across line breaks; the
+# negated class crosses newlines, so multi-line declarations need no
+# continuation state machine.
+_STATIC_FN_RE = re.compile(r'^\s*static\s+([^;]+);', re.MULTILINE)
+
+
 def parse_local_overrides(path):
-  functions = []
-  fndef = None
-  for line in open(path, 'r'):
-    line = line.strip()
-    if not fndef:
-      m = re.match(r'static\s+(.*);', line)
-      if m:
-        functions.append(m.group(1))
-        continue
-      m = re.match(r'static\s+(.*)', line)
-      if m:
-        fndef = m.group(1)
-    else:
-      fndef = '{} {}'.format(fndef, line)
-      if fndef.endswith(';'):
-        functions.append(fndef[:-1])
-        fndef = None
-  assert fndef is None
+  with open(path, 'r') as ff:
+    data = ff.read()
+  # Whitespace runs are collapsed like the old per-line join used to do;
+  # the mapsig keys strip spaces anyway.
+  functions = [
+      ' '.join(m.group(1).split()) for m in _STATIC_FN_RE.finditer(data)
+  ]
 
   overrides = {}
   for fndef in functions:
-    # Discard static XLA type functions which are not ATEN.
+    # Discard static XLA type functions which are not ATEN. The substring
+    # check is a cheap prefilter before the word-boundary regex.
+    if 'Tensor' not in fndef:
+      continue
     is_tensor, fndef = is_tensor_api(fndef)
     if is_tensor:
-      xtree = _XPARSER.parse(fndef)
-      mapsig_key = get_mapsig_key(create_map_sig(xtree, fndef))
+      mapsig_key = fast_mapsig_key(fndef)
+      if mapsig_key is None:
+        mapsig_key = get_mapsig_key(get_map_sig(fndef))
       overrides[mapsig_key] = fndef
   return overrides
 
 
 def generate_unboxed(aten_sig, overload, override_fn):
-  code = '  m.impl_UNBOXED("{}", static_cast<{}>(&{}));\n'.format(
-      aten_sig.split('(')[0].split('::')[1], overload, override_fn)
-  return code
+  name = aten_sig.partition('(')[0].partition('::')[2]
+  return f'  m.impl_UNBOXED("{name}", static_cast<{overload}>(&{override_fn}));\n'
+
+
+# A whole TORCH_LIBRARY_IMPL block, rendered in one substitution from the
+# pre-partitioned registration lines of its dispatch key.
+_REG_BLOCK_TEMPLATE = string.Template(
+    'TORCH_LIBRARY_IMPL(aten, $dispatch_key, m) {\n$body\n}\n')
 
 
-def generate_registrations(fgens, overrides):
-  aten_code = 'TORCH_LIBRARY_IMPL(aten, XLA, m) {\n'
-  autogradxla_code = 'TORCH_LIBRARY_IMPL(aten, AutogradXLA, m) {\n'
+def generate_registration_block(dispatch_key, lines):
+  return _REG_BLOCK_TEMPLATE.substitute(
+      dispatch_key=dispatch_key, body=''.join(lines))
+
+
+def generate_all(fgens, overrides):
+  # Produce the function definitions, the class declarations and the
+  # registrations in a single pass over the fgens, so requires_registration
+  # runs once per fgen instead of once per output.
+  func_parts = []
+  hfunc_parts = []
+  aten_lines = []
+  autogradxla_lines = []
   overridden = set()
   for fgen in fgens:
     if not requires_registration(fgen, overrides):
       continue
-    mapsig_key = get_mapsig_key(fgen.mapsig)
+    if fgen.code:
+      func_parts.append('{}\n\n'.format(fgen.code))
+      hfunc_parts.append('  static {};\n'.format(fgen.rwsig))
+    mapsig_key = fgen.mapsig_key
     if mapsig_key in overrides:
-      override_fn = 'AtenXlaType::{}'.format(fgen.func)
+      override_fn = fgen.xla_qname
       overridden.add(mapsig_key)
     else:
       override_fn = fgen.xfunc if fgen.code else None
     if override_fn:
-      pos = fgen.funsig.find('(')
-      overload = fgen.funsig[:pos] + ' (*)' + fgen.funsig[pos:]
-      unboxed = generate_unboxed(fgen.aten_sig, overload, override_fn)
-      if fgen.mapsig in _FN_AUTOGRAD_XLA:
-        autogradxla_code += unboxed
+      unboxed = generate_unboxed(fgen.aten_sig, fgen.overload, override_fn)
+      if fgen.autograd:
+        autogradxla_lines.append(unboxed)
       else:
-        aten_code += unboxed
-  return aten_code + '\n}\n' + autogradxla_code + '\n}\n', overridden
+        aten_lines.append(unboxed)
+  reg_parts = [
+      generate_registration_block('XLA', aten_lines),
+      generate_registration_block('AutogradXLA', autogradxla_lines),
+  ]
+  return func_parts, hfunc_parts, reg_parts, overridden
 
 
 # For an op that requires_lowering=True:
@@ -1051,50 +1371,39 @@ def generate_registrations(fgens, overrides):
 #     E.g max_pool2d which enforce materializing indices for backward pass to use.
 def requires_registration(fgen, overrides):
   requires_lowering = fgen.dispatch and not fgen.math
-  has_xla_lowering = get_mapsig_key(fgen.mapsig) in overrides
-  has_autogradxla = fgen.mapsig in _FN_AUTOGRAD_XLA or fgen.func in _FN_AUTOGRAD_XLA
-  return requires_lowering or has_xla_lowering or has_autogradxla
-
-
-def generate_functions(fgens, overrides):
-  code = ''
-  for fgen in fgens:
-    if fgen.code and requires_registration(fgen, overrides):
-      code += '{}\n\n'.format(fgen.code)
-  return code
+  has_xla_lowering = fgen.mapsig_key in overrides
+  return requires_lowering or has_xla_lowering or fgen.autograd
 
 
-def generate_class_functions(fgens, overrides):
-  code = ''
-  for fgen in fgens:
-    if fgen.code and requires_registration(fgen, overrides):
-      code += '  static {};\n'.format(fgen.rwsig)
-  return code
-
-
-def gen_output_file(args, name):
+def write_output_file(args, name, data):
+  # When the generated content matches what is already on disk, leave the
+  # file (and its mtime) alone so downstream builds do not recompile it.
+  # Otherwise replace it atomically.
   if not args.output_folder:
-    return sys.stdout
-  return open(os.path.join(args.output_folder, name), 'w')
-
-
-def gen_h_output_file(args):
-  return gen_output_file(args, 'aten_xla_type_default.h')
-
-
-def gen_cpp_output_file(args):
-  return gen_output_file(args, 'aten_xla_type_default.cpp')
+    sys.stdout.write(data)
+    return
+  path = os.path.join(args.output_folder, name)
+  try:
+    with open(path, 'r') as outfile:
+      if outfile.read() == data:
+        return
+  except IOError:
+    pass
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'w') as outfile:
+    outfile.write(data)
+  os.replace(tmp_path, path)
 
 
 def check_overrides(overrides, overridden):
   misses = 0
-  for mapsig, cpp_sig in overrides.items():
-    mapsig_key = get_mapsig_key(mapsig)
+  # The overrides dict is already keyed by mapsig key.
+  for mapsig_key, cpp_sig in overrides.items():
     if not mapsig_key in overridden:
       misses += 1
       print(
           'AtenXlaType function missed override: {}; // {}'.format(
-              cpp_sig, mapsig),
+              cpp_sig, mapsig_key),
           file=sys.stderr)
   return misses == 0
 
@@ -1112,33 +1421,29 @@ def generate(args):
       '{} function overrides in {}'.format(len(overrides), args.xlatype),
       file=sys.stderr)
 
-  fgens = []
   ctx = Context(args.functions)
-  for ts in fndefs:
-    try:
-      fgen = get_xla_wrapper(ts, ctx)
-      if fgen:
-        fgens.append(fgen)
-    except Exception as e:
-      print(
-          'Failed to generate wrapper for {}: {}'.format(ts, e),
-          file=sys.stderr)
+  fgens = create_fgens(fndefs, ctx)
   print(
       'Generated {} wrappers for {}'.format(len(fgens), args.typedef),
       file=sys.stderr)
 
-  functions = generate_functions(fgens, overrides)
-  hfunctions = generate_class_functions(fgens, overrides)
-  regs, overridden = generate_registrations(fgens, overrides)
+  func_parts, hfunc_parts, reg_parts, overridden = generate_all(fgens, overrides)
   assert check_overrides(overrides, overridden)
-  # Create output files ...
-  print(
-      _H_HEADER.format(gen=os.path.basename(sys.argv[0]), hfuncs=hfunctions),
-      file=gen_h_output_file(args))
-  print(
-      _CPP_HEADER.format(
-          gen=os.path.basename(sys.argv[0]), funcs=functions, regs=regs),
-      file=gen_cpp_output_file(args))
+  # Assemble each output from its fragments with a single join, and only
+  # touch the files whose content actually changed.
+  gen = os.path.basename(sys.argv[0])
+  hparts = [_H_HEADER_PRE.substitute(gen=gen)]
+  hparts.extend(hfunc_parts)
+  hparts.append(_H_HEADER_POST)
+  hparts.append('\n')
+  write_output_file(args, 'aten_xla_type_default.h', ''.join(hparts))
+  cpp_parts = [_CPP_HEADER_PRE.substitute(gen=gen)]
+  cpp_parts.extend(func_parts)
+  cpp_parts.append(_CPP_FUNCS_REGS_SEP)
+  cpp_parts.extend(reg_parts)
+  cpp_parts.append(_CPP_HEADER_POST)
+  cpp_parts.append('\n')
+  write_output_file(args, 'aten_xla_type_default.cpp', ''.join(cpp_parts))
 
 
 if __name__ == '__main__':